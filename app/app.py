@@ -1,28 +1,67 @@
-from fastapi import FastAPI, HTTPException, status, Body
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+import orjson
 import uvicorn
 
+from app.models import DispensationRequest, DispenseBulkInput, DispenseInput
+
 from app.controlador.PatientCrud import (
     WritePatient,
     RegisterMedicationDispense,
+    RegisterMedicationDispenseBulk,
     GetPatientById,
-    GetPatientMedications
+    GetPatientMedications,
+    GetPatientWithMedications,
+    IterPatientMedications,
+    EnsureIndexes,
+    patient_collection,
+    PatientExists
 )
 
+class MongoORJSONResponse(ORJSONResponse):
+    """ORJSONResponse con default=str: ObjectId y otros tipos BSON que
+    lleguen a la respuesta se serializan en la pasada de orjson, sin un
+    recorrido previo de conversión por documento en Python."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str)
+
+
 app = FastAPI(
     title="API de Dispensación de Medicamentos",
     description="API para gestión de dispensación de medicamentos en formato FHIR",
     version="1.0.0",
-    docs_url="/docs"
+    docs_url="/docs",
+    default_response_class=MongoORJSONResponse
 )
 
+# Payload constante de la raíz: se codifica una sola vez al arrancar,
+# los health-checks del balanceador no pagan serialización por visita
+_ROOT_BYTES = orjson.dumps({
+    "status": "API funcionando",
+    "routes": ["/docs", "/patient", "/patient/{id}/medications"]
+})
+
 @app.api_route("/", methods=["GET", "HEAD"])  # Soporta GET y HEAD
 def root():
-    return {
-        "status": "API funcionando",
-        "routes": ["/docs", "/patient", "/patient/{id}/medications"]
-    }
+    return Response(content=_ROOT_BYTES, media_type="application/json")
+
+
+@app.on_event("startup")
+async def startup():
+    # Primer handshake TCP+TLS con Atlas antes de recibir tráfico, para
+    # que el primer request de cada worker no pague el arranque en frío
+    await patient_collection.database.client.admin.command("ping")
+    await EnsureIndexes()
+
+
+@app.get("/health")
+async def health():
+    """Verifica la conexión a MongoDB y mantiene el pool activo."""
+    await patient_collection.database.client.admin.command("ping")
+    return {"status": "ok"}
 
 
 # CORS para permitir acceso desde frontend
@@ -33,32 +72,97 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# El historial de medicamentos es JSON repetitivo muy comprimible;
+# gzip reduce los bytes en el cable ~5-10x para respuestas grandes
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+
+
+@app.get("/patient/{patient_id}", summary="Consultar paciente")
+async def get_patient(patient_id: str):
+    result, patient = await GetPatientById(patient_id)
+    if result == "success":
+        return patient
+    if result == "notFound":
+        raise HTTPException(status_code=404, detail="Paciente no encontrado")
+    raise HTTPException(status_code=500, detail=result)
+
+
+@app.get("/patient/{patient_id}/medications", summary="Historial de medicamentos")
+async def get_patient_medications(
+    patient_id: str, include_patient: bool = False, stream: bool = False
+):
+    if stream:
+        # Mismo 404 que las rutas sin streaming: el flag no debe cambiar
+        # la semántica de error para IDs inexistentes o malformados
+        if not await PatientExists(patient_id):
+            raise HTTPException(status_code=404, detail="Paciente no encontrado")
+
+        # NDJSON en streaming: memoria constante para historiales largos
+        async def ndjson():
+            async for med in IterPatientMedications(patient_id):
+                yield orjson.dumps(med, default=str) + b"\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    if include_patient:
+        # Paciente + historial en un solo round-trip vía $lookup
+        result, record = await GetPatientWithMedications(patient_id)
+        if result == "success":
+            return record
+    else:
+        result, medications = await GetPatientMedications(patient_id)
+        if result == "success":
+            return medications
+    if result == "notFound":
+        raise HTTPException(status_code=404, detail="Paciente no encontrado")
+    raise HTTPException(status_code=500, detail=result)
+
+
+@app.post("/medication-dispense", summary="Registrar dispensación a paciente existente")
+async def add_medication_dispense(dispense: DispenseInput):
+    """
+    FastAPI valida el cuerpo una sola vez contra DispenseInput; el CRUD
+    recibe los campos ya tipados sin volver a parsear el request.
+    """
+    result, medication_id = await RegisterMedicationDispense(
+        dispense.patient_id,
+        {
+            "medicationName": dispense.medication_name,
+            "quantity": dispense.quantity,
+            "daysSupply": dispense.days_supply,
+            "dosage": dispense.dosage,
+            "dispenseKey": dispense.dispense_key,
+        },
+        validate=False,  # DispenseInput ya garantiza los campos
+    )
+    if result == "success":
+        return {"status": "success", "medication_id": medication_id}
+    if result == "patientNotFound":
+        raise HTTPException(status_code=404, detail="Paciente no encontrado")
+    raise HTTPException(status_code=500, detail=result)
+
+
+@app.post("/medication-dispense/bulk", summary="Registrar lote de dispensaciones")
+async def add_medication_dispense_bulk(payload: DispenseBulkInput):
+    result, medication_ids = await RegisterMedicationDispenseBulk(
+        payload.patient_id,
+        [
+            {
+                "medicationName": m.medication_name,
+                "quantity": m.quantity,
+                "daysSupply": m.days_supply,
+                "dosage": m.dosage,
+            }
+            for m in payload.medications
+        ],
+        validate=False,  # MedicationItem ya garantiza los campos
+    )
+    if result == "success":
+        return {"status": "success", "medication_ids": medication_ids}
+    if result == "patientNotFound":
+        raise HTTPException(status_code=404, detail="Paciente no encontrado")
+    raise HTTPException(status_code=500, detail=result)
 
 
-class PatientData(BaseModel):
-    document: str
-
-class MedicationData(BaseModel):
-    nameMedicine: str
-    presentation: str
-    dose: str
-    amount: int
-    diagnosis: str
-    recipeDate: str
-    institution: str
-    observations: str
-
-class DispensationRequest(BaseModel):
-    patient: PatientData
-    medication: MedicationData
-    
-class DispenseInput(BaseModel):
-    patient_id: str
-    medication_name: str
-    quantity: float
-    days_supply: float
-    dosage: str
-
 # ========== NUEVO ENDPOINT UNIFICADO ==========
 
 @app.post("/medications", summary="Registrar paciente + medicamento")
@@ -71,15 +175,14 @@ async def register_dispensation(payload: DispensationRequest):
     patient_payload = {
         "document": payload.patient.document
     }
-    status_p, patient_id = WritePatient(patient_payload)
+    status_p, patient_id = await WritePatient(patient_payload)
 
     if status_p != "success":
         raise HTTPException(status_code=422, detail="Error registrando paciente")
 
     # 2. Guardar medicamento
-    medication_payload = payload.medication.dict()
-    print("medication_payload:", medication_payload)
-    status_m, medication_id = RegisterMedicationDispense(patient_id, medication_payload)
+    medication_payload = payload.medication.model_dump(mode="json", exclude_none=True)
+    status_m, medication_id = await RegisterMedicationDispense(patient_id, medication_payload)
 
     if status_m != "success":
         raise HTTPException(status_code=500, detail="Error registrando medicamento")
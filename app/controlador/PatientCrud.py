@@ -1,26 +1,142 @@
+import logging
+
 from connection import connect_to_mongodb
 from bson import ObjectId
-from datetime import datetime
+from bson.errors import InvalidId
+from pymongo.errors import PyMongoError
+from pymongo.write_concern import WriteConcern
+from cachetools import TTLCache
+from datetime import datetime, timezone
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
 
-# Conexión a colecciones MongoDB
+# Conexión a colecciones MongoDB (Motor, asíncronas)
 patient_collection = connect_to_mongodb("SamplePatientService", "patient")
 medication_collection = connect_to_mongodb("SamplePatientService", "medications")
 
-def GetPatientById(patient_id: str):
+# Vista de escritura rápida para el log de dispensaciones: w=1 sin
+# esperar el fsync del journal. Aceptable para registros de dispensación
+# de alto volumen; los pacientes siguen con el write concern por defecto.
+_medication_writes = medication_collection.with_options(
+    write_concern=WriteConcern(w=1, j=False)
+)
+
+# Cache de existencia de pacientes: dispensar varios medicamentos al mismo
+# paciente no debe costar un round-trip a Mongo cada vez. Solo se cachean
+# resultados positivos para no enmascarar pacientes recién creados.
+_patient_exists_cache = TTLCache(maxsize=10_000, ttl=60)
+
+# Cache documento -> _id: el mapeo es inmutable una vez creado el paciente,
+# así que los mensajes repetidos del mismo documento no tocan Mongo
+_document_id_cache = TTLCache(maxsize=10_000, ttl=3600)
+
+# Campos obligatorios de una dispensación; la diferencia de conjuntos se
+# evalúa en C y reporta todos los faltantes de una vez
+_REQUIRED_MED = frozenset({"medicationName", "quantity", "daysSupply", "dosage"})
+
+@lru_cache(maxsize=4096)
+def _oid(patient_id: str) -> ObjectId:
+    """Memoiza la validación hex + conversión a ObjectId de IDs calientes."""
+    return ObjectId(patient_id)
+
+def _build_dispense_record(patient_id: str, medication_data: dict, now: datetime) -> dict:
+    """
+    Construye el registro MedicationDispense (forma fija, conocida-buena).
+    Al ser un solo sitio de construcción lo reutilizan la ruta unitaria y
+    cualquier ruta por lotes sin repetir el literal anidado.
+    """
+    return {
+        "resourceType": "MedicationDispense",
+        "status": "completed",
+        "medicationCodeableConcept": {
+            "text": medication_data["medicationName"]
+        },
+        "subject": {
+            "reference": f"Patient/{patient_id}",
+            # Denormalizado: ObjectId binario de 12 bytes para filtrar sin
+            # concatenar "Patient/..." ni comparar strings en el índice
+            "patientId": _oid(patient_id)
+        },
+        "quantity": {
+            "value": float(medication_data["quantity"]),
+            "unit": "unidades"
+        },
+        "daysSupply": {
+            "value": float(medication_data["daysSupply"]),
+            "unit": "días"
+        },
+        "dosageInstruction": [
+            {"text": medication_data["dosage"]}
+        ],
+        "createdAt": now
+    }
+
+async def EnsureIndexes() -> None:
+    """
+    Crea los índices que usan las consultas calientes (una vez al arrancar):
+      - medications: subject.reference + createdAt para el historial ordenado
+      - patient: document único para el dedupe de WritePatient
+    """
+    try:
+        await medication_collection.create_index(
+            [("subject.reference", 1), ("createdAt", -1)]
+        )
+        # Variante denormalizada: claves ObjectId de 12 bytes, hojas de
+        # índice más compactas que la referencia string "Patient/..."
+        await medication_collection.create_index(
+            [("subject.patientId", 1), ("createdAt", -1)]
+        )
+        await patient_collection.create_index("document", unique=True)
+        # Índice de idempotencia parcial: solo las dispensaciones con
+        # clave entran al índice único. sparse=True no sirve aquí: en un
+        # índice compuesto basta con que exista subject.reference para
+        # indexar (reference, null) y el unique rechazaría la segunda
+        # dispensación sin clave del mismo paciente.
+        await medication_collection.create_index(
+            [("subject.reference", 1), ("dispenseKey", 1)],
+            unique=True,
+            partialFilterExpression={"dispenseKey": {"$exists": True}}
+        )
+    except PyMongoError:
+        logger.exception("No se pudieron crear índices")
+
+async def PatientExists(patient_id: str) -> bool:
+    """Chequeo de existencia puro: solo viaja el _id por el cable."""
+    try:
+        oid = _oid(patient_id)
+    except InvalidId:
+        return False
+    # count con limit=1: el servidor responde 0/1 desde el índice _id
+    # sin materializar ningún documento
+    count = await patient_collection.count_documents({"_id": oid}, limit=1)
+    return count == 1
+
+# Alias interno: los caminos calientes de este módulo lo usan bajo el
+# nombre privado
+_patient_exists = PatientExists
+
+async def GetPatientById(patient_id: str) -> tuple[str, dict | None]:
     """Obtiene un paciente por su ID (simplificado)."""
     try:
-        patient = patient_collection.find_one(
-            {"_id": ObjectId(patient_id)},
+        oid = _oid(patient_id)
+    except InvalidId:
+        # ID malformado: no vale la pena ni consultar Mongo
+        return "notFound", None
+    try:
+        patient = await patient_collection.find_one(
+            {"_id": oid},
             {"document": 1}  # Solo documento (ID del paciente)
         )
         if patient:
-            patient["_id"] = str(patient["_id"])
+            # _id ya llega como str gracias al codec de connection.py
             return "success", patient
         return "notFound", None
-    except Exception as e:
-        return f"error: {str(e)}", None
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        return "dbError", None
 
-def WritePatient(patient_data: dict):
+async def WritePatient(patient_data: dict) -> tuple[str, str | None]:
     """
     Crea un nuevo paciente con datos mínimos (documento).
     Se espera patient_data = {"document": "número_documento"}
@@ -29,24 +145,39 @@ def WritePatient(patient_data: dict):
         document = patient_data.get("document")
         if not document:
             return "missingField: document", None
-        
-        # Verificar si ya existe paciente con ese documento
-        existing = patient_collection.find_one({"document": document})
+
+        cached_id = _document_id_cache.get(document)
+        if cached_id:
+            return "success", cached_id
+
+        # Upsert: crea el paciente si no existe en un solo round-trip,
+        # en lugar del par find_one + insert_one (el índice único sobre
+        # document garantiza que no se duplique bajo concurrencia)
+        result = await patient_collection.update_one(
+            {"document": document},
+            {"$setOnInsert": {"document": document, "createdAt": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+        if result.upserted_id is not None:
+            patient_id = str(result.upserted_id)
+            _document_id_cache[document] = patient_id
+            return "success", patient_id
+
+        # Ya existía: un solo find_one para recuperar su _id
+        existing = await patient_collection.find_one(
+            {"document": document}, {"_id": 1}
+        )
         if existing:
-            return "success", str(existing["_id"])
-        
-        new_patient = {
-            "document": document,
-            "createdAt": datetime.now()
-        }
-        result = patient_collection.insert_one(new_patient)
-        if result.inserted_id:
-            return "success", str(result.inserted_id)
+            patient_id = str(existing["_id"])
+            _document_id_cache[document] = patient_id
+            return "success", patient_id
         return "errorInserting", None
-    except Exception as e:
-        return f"error: {str(e)}", None
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        return "dbError", None
 
-def RegisterMedicationDispense(patient_id: str, medication_data: dict):
+async def RegisterMedicationDispense(patient_id: str, medication_data: dict,
+                                     validate: bool = True) -> tuple[str, str | None]:
     """
     Registra una dispensación de medicamento para un paciente.
     medication_data debe contener:
@@ -54,53 +185,168 @@ def RegisterMedicationDispense(patient_id: str, medication_data: dict):
       - quantity
       - daysSupply
       - dosage
+    Las rutas tipadas (FastAPI ya validó el cuerpo) pueden pasar
+    validate=False para no repetir el chequeo.
     """
     try:
-        # Verificar paciente existe
-        status, patient = GetPatientById(patient_id)
-        if status != "success":
-            return "patientNotFound", None
-        
-        # Validar campos requeridos
-        for field in ["medicationName", "quantity", "daysSupply", "dosage"]:
-            if field not in medication_data:
-                return f"missingField: {field}", None
-        
-        dispense_record = {
-            "resourceType": "MedicationDispense",
-            "status": "completed",
-            "medicationCodeableConcept": {
-                "text": medication_data["medicationName"]
-            },
-            "subject": {
-                "reference": f"Patient/{patient_id}"
-            },
-            "quantity": {
-                "value": float(medication_data["quantity"]),
-                "unit": "unidades"
-            },
-            "daysSupply": {
-                "value": float(medication_data["daysSupply"]),
-                "unit": "días"
-            },
-            "dosageInstruction": [
-                {"text": medication_data["dosage"]}
-            ],
-            "createdAt": datetime.now()
-        }
-        
-        result = medication_collection.insert_one(dispense_record)
+        # Verificar paciente existe (con cache para pacientes "calientes")
+        if patient_id not in _patient_exists_cache:
+            if not await _patient_exists(patient_id):
+                return "patientNotFound", None
+            _patient_exists_cache[patient_id] = True
+
+        if validate:
+            # Validar campos requeridos (todos los faltantes en una pasada)
+            missing = _REQUIRED_MED - medication_data.keys()
+            if missing:
+                return f"missingField: {sorted(missing)}", None
+
+        dispense_record = _build_dispense_record(
+            patient_id, medication_data, datetime.now(timezone.utc)
+        )
+
+        # Con clave de idempotencia el reintento se vuelve no-op en el
+        # servidor: el upsert con $setOnInsert no duplica el documento
+        dispense_key = medication_data.get("dispenseKey")
+        if dispense_key:
+            dispense_record["dispenseKey"] = dispense_key
+            result = await _medication_writes.update_one(
+                {
+                    "subject.reference": dispense_record["subject"]["reference"],
+                    "dispenseKey": dispense_key,
+                },
+                {"$setOnInsert": dispense_record},
+                upsert=True,
+            )
+            if result.upserted_id is not None:
+                return "success", str(result.upserted_id)
+            existing = await medication_collection.find_one(
+                {
+                    "subject.reference": dispense_record["subject"]["reference"],
+                    "dispenseKey": dispense_key,
+                },
+                {"_id": 1},
+            )
+            return "success", str(existing["_id"]) if existing else None
+
+        result = await _medication_writes.insert_one(dispense_record)
         if result.inserted_id:
             return "success", str(result.inserted_id)
         return "errorInserting", None
-    except Exception as e:
-        return f"error: {str(e)}", None
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        return "dbError", None
+
+async def RegisterMedicationDispenseBulk(patient_id: str, medications: list,
+                                         validate: bool = True) -> tuple[str, list | None]:
+    """
+    Registra un lote de dispensaciones para un paciente con un solo
+    insert_many (una farmacia subiendo el día completo paga un round-trip
+    en vez de N).
+    """
+    try:
+        if not medications:
+            return "emptyBatch", None
+
+        if patient_id not in _patient_exists_cache:
+            if not await _patient_exists(patient_id):
+                return "patientNotFound", None
+            _patient_exists_cache[patient_id] = True
+
+        if validate:
+            for medication_data in medications:
+                missing = _REQUIRED_MED - medication_data.keys()
+                if missing:
+                    return f"missingField: {sorted(missing)}", None
+
+        # Una sola marca de tiempo compartida por todo el lote
+        now = datetime.now(timezone.utc)
+        docs = [_build_dispense_record(patient_id, m, now) for m in medications]
 
-def GetPatientMedications(patient_id: str):
+        result = await _medication_writes.insert_many(docs, ordered=False)
+        return "success", [str(i) for i in result.inserted_ids]
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        return "dbError", None
+
+async def IterPatientMedications(patient_id: str):
+    """
+    Itera el historial de medicamentos sin materializar la lista completa:
+    memoria constante y primer byte apenas llega el primer lote del cursor.
+    """
+    try:
+        oid = _oid(patient_id)
+    except InvalidId:
+        return
+    meds_cursor = medication_collection.find(
+        {"subject.patientId": oid},
+        {
+            "medicationCodeableConcept.text": 1,
+            "quantity": 1,
+            "daysSupply": 1,
+            "dosageInstruction": 1,
+            "createdAt": 1
+        }
+    ).sort("createdAt", -1).batch_size(200)
+
+    async for med in meds_cursor:
+        yield med
+
+async def GetPatientWithMedications(patient_id: str) -> tuple[str, dict | None]:
+    """
+    Obtiene el paciente y su historial de medicamentos en un solo
+    round-trip usando $lookup, en vez de dos consultas secuenciales.
+    """
+    try:
+        oid = _oid(patient_id)
+    except InvalidId:
+        return "notFound", None
+    try:
+        pipeline = [
+            {"$match": {"_id": oid}},
+            {"$lookup": {
+                "from": "medications",
+                "let": {"pid": "$_id"},
+                "pipeline": [
+                    # Igualdad sobre el ObjectId denormalizado: sin
+                    # $concat/$toString por documento y compara binario
+                    {"$match": {"$expr": {"$eq": ["$subject.patientId", "$$pid"]}}},
+                    {"$sort": {"createdAt": -1}},
+                    # Misma proyección que GetPatientMedications: no viajan
+                    # campos que la respuesta no usa
+                    {"$project": {
+                        "medicationCodeableConcept.text": 1,
+                        "quantity": 1,
+                        "daysSupply": 1,
+                        "dosageInstruction": 1,
+                        "createdAt": 1,
+                    }},
+                ],
+                "as": "medications",
+            }},
+            {"$project": {"document": 1, "medications": 1}},
+        ]
+        docs = await patient_collection.aggregate(pipeline).to_list(length=1)
+        if not docs:
+            return "notFound", None
+
+        # Los _id anidados ya vienen como str desde el decode BSON
+        return "success", docs[0]
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        return "dbError", None
+
+async def GetPatientMedications(patient_id: str) -> tuple[str, list | None]:
     """Obtiene historial de medicamentos dispensados a un paciente."""
     try:
+        oid = _oid(patient_id)
+    except InvalidId:
+        return "notFound", None
+    try:
+        # Filtro por ObjectId denormalizado: compara 12 bytes binarios en
+        # el índice en vez de la referencia string "Patient/<id>"
         meds_cursor = medication_collection.find(
-            {"subject.reference": f"Patient/{patient_id}"},
+            {"subject.patientId": oid},
             {
                 "medicationCodeableConcept.text": 1,
                 "quantity": 1,
@@ -108,15 +354,20 @@ def GetPatientMedications(patient_id: str):
                 "dosageInstruction": 1,
                 "createdAt": 1
             }
-        ).sort("createdAt", -1)
-        
-        medications = []
-        for med in meds_cursor:
-            med["_id"] = str(med["_id"])
-            if "createdAt" in med and med["createdAt"]:
-                med["createdAt"] = med["createdAt"].isoformat()
-            medications.append(med)
-        
+        ).sort("createdAt", -1).batch_size(500)
+
+        # batch_size reduce los getMore. El codec BSON ya entrega _id como
+        # str y createdAt queda como datetime: orjson lo emite en RFC3339
+        # sin trabajo por documento en Python.
+        medications = [med async for med in meds_cursor]
+
+        # Solo si no hay resultados vale la pena distinguir "paciente sin
+        # medicamentos" de "paciente inexistente" — un único chequeo extra
+        # en la rama vacía, nunca en el camino caliente
+        if not medications and not await _patient_exists(patient_id):
+            return "notFound", None
+
         return "success", medications
-    except Exception as e:
-        return f"error: {str(e)}", None
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        return "dbError", None
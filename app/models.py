@@ -0,0 +1,41 @@
+from pydantic import BaseModel, Field
+
+
+class PatientData(BaseModel):
+    document: str
+
+class MedicationData(BaseModel):
+    nameMedicine: str
+    presentation: str
+    dose: str
+    amount: int
+    diagnosis: str
+    recipeDate: str
+    institution: str
+    observations: str
+
+class DispensationRequest(BaseModel):
+    patient: PatientData
+    medication: MedicationData
+
+class DispenseInput(BaseModel):
+    patient_id: str
+    medication_name: str
+    quantity: float
+    days_supply: float
+    dosage: str
+    # Clave opcional de idempotencia: reintentos con la misma clave
+    # no duplican la dispensación
+    dispense_key: str | None = None
+
+class MedicationItem(BaseModel):
+    medication_name: str
+    quantity: float
+    days_supply: float
+    dosage: str
+
+class DispenseBulkInput(BaseModel):
+    patient_id: str
+    # Un lote vacío es error del cliente: FastAPI lo rechaza con 422
+    # antes de llegar al CRUD
+    medications: list[MedicationItem] = Field(min_length=1)
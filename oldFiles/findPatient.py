@@ -1,7 +1,13 @@
-from pymongo import MongoClient
-from pymongo.server_api import ServerApi
+import logging
+
+from pymongo.errors import PyMongoError
 from bson import ObjectId
-from datetime import datetime
+
+# Helpers canónicos compartidos: readPatient.py es la única copia del
+# cliente cacheado y del literal MedicationDispense
+from readPatient import _get_client, build_dispense_record
+
+logger = logging.getLogger(__name__)
 
 def connect_to_mongodb(db_name: str, collection_name: str, uri: str):
     """
@@ -11,15 +17,14 @@ def connect_to_mongodb(db_name: str, collection_name: str, uri: str):
         db_name: Nombre de la base de datos
         collection_name: Nombre de la colección
         uri: Cadena de conexión MongoDB
-    
+
     Returns:
         Objeto de colección MongoDB
     """
     try:
-        client = MongoClient(uri, server_api=ServerApi('1'))
-        return client[db_name][collection_name]
-    except Exception as e:
-        print(f"Error de conexión: {str(e)}")
+        return _get_client(uri)[db_name][collection_name]
+    except PyMongoError:
+        logger.exception("Error de conexión")
         raise
 
 def get_patient_minimal_data(collection, patient_id: str):
@@ -33,6 +38,10 @@ def get_patient_minimal_data(collection, patient_id: str):
     Returns:
         Dict con datos básicos del paciente o None si no se encuentra
     """
+    # Chequeo rápido de 24-hex: un ID malformado no vale ni la excepción
+    # de ObjectId() ni el round-trip a Mongo
+    if not ObjectId.is_valid(patient_id):
+        return None
     try:
         patient = collection.find_one(
             {"_id": ObjectId(patient_id)},
@@ -44,8 +53,9 @@ def get_patient_minimal_data(collection, patient_id: str):
         if patient:
             patient["_id"] = str(patient["_id"])
         return patient
-    except Exception as e:
-        print(f"Error en búsqueda de paciente: {str(e)}")
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        logger.exception("Error en búsqueda de paciente")
         return None
 
 def log_dispensed_medication(med_collection, patient_id: str, med_data: dict):
@@ -61,35 +71,15 @@ def log_dispensed_medication(med_collection, patient_id: str, med_data: dict):
         String con ObjectId del registro creado o None en caso de error
     """
     try:
-        dispense_record = {
-            "resourceType": "MedicationDispense",
-            "status": "completed",
-            "medicationCodeableConcept": {
-                "text": med_data.get("medicationName")
-            },
-            "subject": {
-                "reference": f"Patient/{patient_id}"
-            },
-            "quantity": {
-                "value": float(med_data.get("quantity")),
-                "unit": "unidades"
-            },
-            "daysSupply": {
-                "value": float(med_data.get("daysSupply")),
-                "unit": "días"
-            },
-            "dosageInstruction": [{
-                "text": med_data.get("dosage")
-            }],
-            "createdAt": datetime.now()
-        }
-        
+        dispense_record = build_dispense_record(patient_id, med_data)
+
         result = med_collection.insert_one(dispense_record)
         if result.inserted_id:
             return str(result.inserted_id)
         return None
-    except Exception as e:
-        print(f"Error al registrar medicamento: {str(e)}")
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        logger.exception("Error al registrar medicamento")
         return None
 
 
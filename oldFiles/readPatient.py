@@ -1,28 +1,74 @@
+import logging
+
 from pymongo import MongoClient
+from pymongo.errors import PyMongoError
 from pymongo.server_api import ServerApi
 from bson import ObjectId
-from datetime import datetime
+from cachetools import TTLCache
+from datetime import datetime, timezone
+from functools import lru_cache
 from typing import Dict, Optional
 
+logger = logging.getLogger(__name__)
+
+# Cache de datos de paciente: los demográficos cambian rara vez, así que
+# dispensaciones repetidas al mismo paciente no pagan el round-trip.
+# Solo se cachean aciertos para no enmascarar pacientes recién creados.
+_patient_cache = TTLCache(maxsize=10_000, ttl=3600)
+
+@lru_cache(maxsize=8)
+def _get_client(uri: str) -> MongoClient:
+    """Cliente cacheado por URI: comparte el pool entre llamadas en vez de
+    reconstruir cliente (y hilo monitor) por conexión."""
+    return MongoClient(uri, server_api=ServerApi('1'))
+
+# Bandera de una sola pasada: create_index es idempotente pero cuesta un
+# round-trip; no hace falta repetirlo en cada conexión del mismo proceso
+_indexes_ensured = False
+
+def _ensure_indexes(collections: Dict) -> None:
+    """
+    Crea los índices de las dos formas de consulta calientes (una vez por
+    proceso): sin ellos el historial por paciente hace COLLSCAN y ordena
+    en memoria.
+    """
+    global _indexes_ensured
+    if _indexes_ensured:
+        return
+    try:
+        # Historial por paciente ordenado por fecha: el índice compuesto
+        # cubre el filtro y provee el sort
+        collections['medications'].create_index(
+            [('subject.reference', 1), ('createdAt', -1)]
+        )
+        # Búsqueda de pacientes por identificador
+        collections['patients'].create_index(
+            [('identifier.type.text', 1), ('identifier.value', 1)]
+        )
+        _indexes_ensured = True
+    except PyMongoError:
+        logger.exception("No se pudieron crear índices")
+
 def connect_to_mongodb(uri: str, db_name: str) -> Dict[str, MongoClient]:
     """
     Conexión segura a MongoDB para sistema de dispensación
-    
+
     Args:
         uri: Cadena de conexión MongoDB
         db_name: Nombre de la base de datos
-    
+
     Returns:
         Diccionario con las colecciones necesarias
     """
     try:
-        client = MongoClient(uri, server_api=ServerApi('1'))
-        db = client[db_name]
-        return {
+        db = _get_client(uri)[db_name]
+        collections = {
             'patients': db['patient'],
             'medications': db['medications']
         }
-    except Exception as e:
+        _ensure_indexes(collections)
+        return collections
+    except PyMongoError as e:
         raise ConnectionError(f"Error de conexión a MongoDB: {str(e)}")
 
 def get_patient_for_dispensing(collections: Dict, patient_id: str) -> Optional[Dict]:
@@ -36,6 +82,13 @@ def get_patient_for_dispensing(collections: Dict, patient_id: str) -> Optional[D
     Returns:
         Datos básicos del paciente o None si no se encuentra
     """
+    # Chequeo rápido de 24-hex: un ID malformado no vale ni la excepción
+    # de ObjectId() ni el round-trip a Mongo
+    if not ObjectId.is_valid(patient_id):
+        return None
+    cached = _patient_cache.get(patient_id)
+    if cached is not None:
+        return cached
     try:
         patient = collections['patients'].find_one(
             {'_id': ObjectId(patient_id)},
@@ -43,11 +96,158 @@ def get_patient_for_dispensing(collections: Dict, patient_id: str) -> Optional[D
         )
         if patient:
             patient['_id'] = str(patient['_id'])
+            _patient_cache[patient_id] = patient
         return patient
-    except Exception as e:
-        print(f"Error al buscar paciente: {str(e)}")
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        logger.exception("Error al buscar paciente")
         return None
 
+def iter_patient_medications(collections: Dict, patient_id: str):
+    """
+    Itera el historial de dispensaciones de un paciente sin materializar
+    la lista completa: el cursor trae lotes de 200 y el consumidor puede
+    empezar a trabajar con el primer lote.
+
+    Args:
+        collections: Diccionario con colecciones MongoDB
+        patient_id: ID del paciente
+
+    Returns:
+        Generador de documentos MedicationDispense (más reciente primero)
+    """
+    cursor = collections['medications'].find(
+        {'subject.reference': f'Patient/{patient_id}'},
+        {
+            'medicationCodeableConcept.text': 1,
+            'quantity': 1,
+            'daysSupply': 1,
+            'dosageInstruction': 1,
+            'createdAt': 1
+        }
+    ).sort('createdAt', -1).batch_size(200)
+    for med in cursor:
+        med['_id'] = str(med['_id'])
+        yield med
+
+def get_medications_for_patients(collections: Dict, patient_ids: list) -> Dict[str, list]:
+    """
+    Obtiene los historiales de varios pacientes con una sola consulta $in,
+    en vez de N consultas (una por paciente). Una pasada por el cursor
+    agrupa los documentos por paciente del lado del cliente.
+
+    Args:
+        collections: Diccionario con colecciones MongoDB
+        patient_ids: Lista de IDs de paciente
+
+    Returns:
+        Dict patient_id -> lista de dispensaciones (más reciente primero)
+    """
+    results: Dict[str, list] = {pid: [] for pid in patient_ids}
+    if not patient_ids:
+        return results
+    try:
+        refs = [f'Patient/{pid}' for pid in patient_ids]
+        cursor = collections['medications'].find(
+            {'subject.reference': {'$in': refs}},
+            {
+                'medicationCodeableConcept.text': 1,
+                'subject.reference': 1,
+                'quantity': 1,
+                'daysSupply': 1,
+                'dosageInstruction': 1,
+                'createdAt': 1
+            }
+        ).sort('createdAt', -1).batch_size(200)
+        for med in cursor:
+            med['_id'] = str(med['_id'])
+            # 'Patient/<id>' -> '<id>' para agrupar por paciente
+            pid = med['subject']['reference'].split('/', 1)[1]
+            results[pid].append(med)
+        return results
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        logger.exception("Error al consultar medicamentos por lote")
+        return results
+
+def get_medications_by_date_range(
+    collections: Dict,
+    start_date: datetime,
+    end_date: datetime
+) -> list:
+    """
+    Obtiene dispensaciones en un rango de fechas.
+
+    Compara fechas BSON nativas (no strings isoformat): el rango usa el
+    índice sobre createdAt y la comparación numérica del servidor.
+
+    Args:
+        collections: Diccionario con colecciones MongoDB
+        start_date: Inicio del rango (datetime con tz UTC)
+        end_date: Fin del rango (datetime con tz UTC)
+
+    Returns:
+        Lista de documentos MedicationDispense del rango
+    """
+    try:
+        cursor = collections['medications'].find(
+            {'createdAt': {'$gte': start_date, '$lte': end_date}},
+            {
+                'medicationCodeableConcept.text': 1,
+                'subject.reference': 1,
+                'quantity': 1,
+                'daysSupply': 1,
+                'createdAt': 1
+            }
+        ).sort('createdAt', -1).batch_size(200)
+        results = []
+        for med in cursor:
+            med['_id'] = str(med['_id'])
+            results.append(med)
+        return results
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        logger.exception("Error al consultar rango de fechas")
+        return []
+
+def build_dispense_record(patient_id: str, medication_data: Dict) -> Dict:
+    """
+    Construye el documento MedicationDispense a insertar. Único sitio de
+    construcción del literal: lo comparten readPatient y findPatient en
+    vez de mantener dos copias del mismo dict anidado.
+
+    Args:
+        patient_id: ID del paciente
+        medication_data: Datos del medicamento (campos requeridos ya
+            verificados por el llamador)
+
+    Returns:
+        Documento listo para insert_one
+    """
+    return {
+        'resourceType': 'MedicationDispense',
+        'status': 'completed',
+        'medicationCodeableConcept': {
+            'text': medication_data['medicationName']
+        },
+        'subject': {
+            'reference': f'Patient/{patient_id}'
+        },
+        'quantity': {
+            'value': float(medication_data['quantity']),
+            'unit': 'unidades'
+        },
+        'daysSupply': {
+            'value': float(medication_data['daysSupply']),
+            'unit': 'días'
+        },
+        'dosageInstruction': [{
+            'text': medication_data['dosage']
+        }],
+        # UTC tz-aware: se guarda como Date BSON comparable, no texto
+        'createdAt': datetime.now(timezone.utc)
+    }
+
 def register_medication_dispense(
     collections: Dict, 
     patient_id: str,
@@ -66,37 +266,29 @@ def register_medication_dispense(
     """
     required_fields = ['medicationName', 'quantity', 'daysSupply', 'dosage']
     if not all(field in medication_data for field in required_fields):
-        print("Faltan campos requeridos en los datos del medicamento")
+        logger.warning("Faltan campos requeridos en los datos del medicamento")
         return None
-    
+
+    if not ObjectId.is_valid(patient_id):
+        logger.warning("ID de paciente malformado: %s", patient_id)
+        return None
+
     try:
-        dispense_record = {
-            'resourceType': 'MedicationDispense',
-            'status': 'completed',
-            'medicationCodeableConcept': {
-                'text': medication_data['medicationName']
-            },
-            'subject': {
-                'reference': f'Patient/{patient_id}'
-            },
-            'quantity': {
-                'value': float(medication_data['quantity']),
-                'unit': 'unidades'
-            },
-            'daysSupply': {
-                'value': float(medication_data['daysSupply']),
-                'unit': 'días'
-            },
-            'dosageInstruction': [{
-                'text': medication_data['dosage']
-            }],
-            'createdAt': datetime.now()
-        }
-        
+        # Chequeo de existencia barato: count con limit=1 responde 0/1
+        # desde el índice _id sin materializar el documento del paciente
+        if collections['patients'].count_documents(
+            {'_id': ObjectId(patient_id)}, limit=1
+        ) == 0:
+            logger.warning("Paciente no encontrado: %s", patient_id)
+            return None
+
+        dispense_record = build_dispense_record(patient_id, medication_data)
+
         result = collections['medications'].insert_one(dispense_record)
         return str(result.inserted_id)
-    except Exception as e:
-        print(f"Error al registrar dispensación: {str(e)}")
+    except PyMongoError:
+        # Solo errores del driver: los bugs de programación deben propagarse
+        logger.exception("Error al registrar dispensación")
         return None
 
 if __name__ == '__main__':
@@ -1,7 +1,50 @@
-import json
-from pymongo import MongoClient
-from pymongo.server_api import ServerApi
-from datetime import datetime
+import logging
+
+from bson import ObjectId
+from concurrent.futures import Future, ThreadPoolExecutor
+from pymongo.errors import PyMongoError
+from datetime import datetime, timezone
+from typing import Final, TypedDict
+
+# Constantes de campos fijos FHIR: CPython no interna URLs ni strings
+# acentuados, así que reusar el mismo objeto evita re-hash por registro
+_RT_PATIENT: Final = "Patient"
+_RT_MEDICATION_DISPENSE: Final = "MedicationDispense"
+_STATUS_COMPLETED: Final = "completed"
+_UNIT_UNIDADES: Final = "unidades"
+_UNIT_DIAS: Final = "días"
+_EXT_CREATED_AT_URL: Final = "http://hl7.org/fhir/StructureDefinition/createdAt"
+
+# Cliente cacheado canónico compartido con los demás scripts legados:
+# reutiliza el pool en vez de pagar SRV+TLS por cada conexión pedida
+from readPatient import _get_client
+
+logger = logging.getLogger(__name__)
+
+
+# Bandera de una sola pasada por proceso: create_index es idempotente
+# pero cuesta un round-trip que no hay que repetir por conexión
+_indexes_ensured = False
+
+
+def _ensure_indexes(collections: dict) -> None:
+    """
+    Crea los índices que usa el camino de escritura (una vez por proceso):
+    el probe de existencia va por _id (ya indexado), pero los chequeos por
+    identificador y las lecturas por paciente necesitan los suyos para no
+    degenerar en COLLSCAN al crecer la colección.
+    """
+    global _indexes_ensured
+    if _indexes_ensured:
+        return
+    try:
+        collections['patients'].create_index('identifier.value')
+        collections['medications'].create_index(
+            [('subject.reference', 1)]
+        )
+        _indexes_ensured = True
+    except PyMongoError:
+        logger.exception("No se pudieron crear índices")
 
 
 def connect_to_mongodb(uri: str, db_name: str) -> dict:
@@ -9,22 +52,48 @@ def connect_to_mongodb(uri: str, db_name: str) -> dict:
     Conexión segura a MongoDB para sistema de dispensación
     """
     try:
-        client = MongoClient(uri, server_api=ServerApi('1'))
-        db = client[db_name]
-        return {
+        db = _get_client(uri)[db_name]
+        collections = {
             'patients': db['patients'],
             'medications': db['medications']
         }
+        _ensure_indexes(collections)
+        return collections
     except Exception as e:
         raise ConnectionError(f"Error de conexión a MongoDB: {str(e)}")
 
 
-def save_minimal_patient(collections: dict, identifier: dict, name: dict) -> str:
-    """
-    Guarda un paciente con datos mínimos para dispensación
-    """
-    patient_data = {
-        "resourceType": "Patient",
+# Formas internas de los dicts del camino de escritura: TypedDict da el
+# chequeo estático sin el costo de validar sub-modelos Pydantic anidados
+# para objetos que solo existen dentro de este módulo
+class PatientIdentifier(TypedDict):
+    system: str
+    value: str
+
+
+class PatientName(TypedDict):
+    given: str
+    family: str
+
+
+class DispenseData(TypedDict):
+    patient_id: str
+    medication_name: str
+    quantity: float
+    days_supply: float
+    dosage: str
+
+
+def _now_iso() -> str:
+    """Marca de tiempo UTC en isoformat (una llamada por registro o lote)."""
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _build_patient_record(identifier: PatientIdentifier, name: PatientName,
+                          now_iso: str | None = None) -> dict:
+    """Arma el documento Patient mínimo a insertar."""
+    return {
+        "resourceType": _RT_PATIENT,
         "identifier": [{
             "system": identifier['system'],
             "value": identifier['value']
@@ -33,47 +102,143 @@ def save_minimal_patient(collections: dict, identifier: dict, name: dict) -> str
             "given": [name['given']],
             "family": name['family']
         }],
-        "createdAt": datetime.now().isoformat()
+        "createdAt": now_iso or _now_iso()
     }
 
-    result = collections['patients'].insert_one(patient_data)
+
+def save_minimal_patient(collections: dict, identifier: PatientIdentifier, name: PatientName) -> str:
+    """
+    Guarda un paciente con datos mínimos para dispensación
+    """
+    result = collections['patients'].insert_one(_build_patient_record(identifier, name))
     return str(result.inserted_id)
 
 
-def save_medication_dispense(collections: dict, dispense_data: dict) -> str:
+def save_minimal_patients(collections: dict, records: list) -> list:
     """
-    Registra una dispensación de medicamento con estructura FHIR
+    Guarda un lote de pacientes con un solo insert_many: un round-trip a
+    Atlas para N documentos en vez de N.
+
+    Args:
+        records: Lista de dicts {'identifier': {...}, 'name': {...}}
+
+    Returns:
+        Lista de IDs (str) de los documentos insertados
+    """
+    if not records:
+        return []
+    # Una sola marca de tiempo compartida por el lote: evita N llamadas
+    # a clock_gettime + N strings isoformat idénticos
+    now_iso = _now_iso()
+    docs = [_build_patient_record(r['identifier'], r['name'], now_iso) for r in records]
+    result = collections['patients'].insert_many(docs, ordered=False)
+    return [str(i) for i in result.inserted_ids]
+
+
+def _build_medication_record(*, patient_id: str, medication_name: str,
+                             quantity: float, days_supply: float, dosage: str,
+                             now_iso: str | None = None) -> dict:
+    """Arma el documento MedicationDispense a insertar.
+
+    Recibe los campos como argumentos con nombre: los valores llegan por
+    la pila de llamada, sin los cinco hash-lookups d['clave'] por registro
+    que costaba la versión basada en dict.
     """
-    medication_record = {
-        "resourceType": "MedicationDispense",
-        "status": "completed",
+    return {
+        "resourceType": _RT_MEDICATION_DISPENSE,
+        "status": _STATUS_COMPLETED,
         "medicationCodeableConcept": {
-            "text": dispense_data['medication_name']
+            "text": medication_name
         },
         "subject": {
-            "reference": f"Patient/{dispense_data['patient_id']}"
+            "reference": f"Patient/{patient_id}"
         },
         "quantity": {
-            "value": float(dispense_data['quantity']),
-            "unit": "unidades"
+            "value": float(quantity),
+            "unit": _UNIT_UNIDADES
         },
         "daysSupply": {
-            "value": float(dispense_data['days_supply']),
-            "unit": "días"
+            "value": float(days_supply),
+            "unit": _UNIT_DIAS
         },
         "dosageInstruction": [{
-            "text": dispense_data['dosage']
+            "text": dosage
         }],
         "extension": [{
-            "url": "http://hl7.org/fhir/StructureDefinition/createdAt",
-            "valueDateTime": datetime.now().isoformat()
+            "url": _EXT_CREATED_AT_URL,
+            "valueDateTime": now_iso or _now_iso()
         }]
     }
 
-    result = collections['medications'].insert_one(medication_record)
+
+def save_medication_dispense(collections: dict, *, patient_id: str,
+                             medication_name: str, quantity: float,
+                             days_supply: float, dosage: str,
+                             now_iso: str | None = None) -> str:
+    """
+    Registra una dispensación de medicamento con estructura FHIR
+    """
+    # Probe de existencia con el _id convertido a ObjectId: un filtro con
+    # el string nunca coincide con el ObjectId almacenado, y count con
+    # limit=1 responde desde el índice sin traer el documento
+    if not ObjectId.is_valid(patient_id) or collections['patients'].count_documents(
+        {"_id": ObjectId(patient_id)}, limit=1
+    ) == 0:
+        raise ValueError(f"Paciente no encontrado: {patient_id}")
+
+    record = _build_medication_record(
+        patient_id=patient_id,
+        medication_name=medication_name,
+        quantity=quantity,
+        days_supply=days_supply,
+        dosage=dosage,
+        now_iso=now_iso,
+    )
+    result = collections['medications'].insert_one(record)
     return str(result.inserted_id)
 
 
+def save_medication_dispenses(collections: dict, records: list[DispenseData]) -> list:
+    """
+    Registra un lote de dispensaciones con un solo insert_many: amortiza
+    el RTT de red entre los N documentos del lote.
+
+    Args:
+        records: Lista de DispenseData (los campos de save_medication_dispense)
+
+    Returns:
+        Lista de IDs (str) de los registros insertados
+    """
+    if not records:
+        return []
+    # Una sola marca de tiempo compartida por el lote
+    now_iso = _now_iso()
+    docs = [_build_medication_record(now_iso=now_iso, **r) for r in records]
+    result = collections['medications'].insert_many(docs, ordered=False)
+    return [str(i) for i in result.inserted_ids]
+
+
+# Pool compartido para solapar la E/S de red de escrituras independientes:
+# el hilo llamador no queda bloqueado el RTT completo a Atlas por escritura
+# (la app FastAPI usa Motor asíncrono; esto es el equivalente para estos
+# scripts síncronos)
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="dispense-io")
+
+
+def submit_save_minimal_patient(collections: dict, identifier: PatientIdentifier,
+                                name: PatientName) -> Future:
+    """Encola el guardado del paciente en el pool y devuelve un Future."""
+    return _EXECUTOR.submit(save_minimal_patient, collections, identifier, name)
+
+
+def submit_save_medication_dispense(collections: dict, **kwargs) -> Future:
+    """Encola el registro de la dispensación y devuelve un Future.
+
+    Acepta los mismos argumentos con nombre que save_medication_dispense.
+    """
+    return _EXECUTOR.submit(save_medication_dispense, collections, **kwargs)
+
+
 if __name__ == "__main__":
     # Configuración - usar variables de entorno en producción
     CONFIG = {
@@ -96,13 +261,11 @@ if __name__ == "__main__":
         # 3. Registrar dispensación
         dispense_id = save_medication_dispense(
             collections,
-            {
-                'patient_id': patient_id,
-                'medication_name': 'Paracetamol 500mg',
-                'quantity': 30,
-                'days_supply': 10,
-                'dosage': '1 tableta cada 8 horas'
-            }
+            patient_id=patient_id,
+            medication_name='Paracetamol 500mg',
+            quantity=30,
+            days_supply=10,
+            dosage='1 tableta cada 8 horas'
         )
         print(f"Dispensación registrada con ID: {dispense_id}")
 